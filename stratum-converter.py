@@ -6,17 +6,48 @@ import sys
 import os
 import urllib.parse
 
-import base58
 import sha3
 
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from aiorpcx import RPCSession, JSONRPCConnection, JSONRPCAutoDetect, Request, serve_rs, handler_invocation, RPCError, TaskGroup
 from functools import partial
 from hashlib import sha256
-from typing import Set, List, Optional
+from typing import Set, List, Optional, Sequence, Tuple
+
+try:
+    # Optional, but parses the (potentially multi MB) block templates much faster
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode('utf8')
+    json_loads = json.loads
 
 
 KAWPOW_EPOCH_LENGTH = 7500
+# Constant pieces of the coinbase transaction
+# Note that there is a max allowed length of arbitrary data.
+# I forget what it is (TODO lol) but note that this string is close
+# to the max.
+ARBITRARY_DATA = b'with a little help from http://github.com/kralverde/ravencoin-stratum-proxy'
+
+COINBASE_VERSION = (1).to_bytes(4, 'little')
+SEGWIT_MARKER_FLAG = b'\x00\x01'
+# Null prevout: no txid, index 0xffffffff
+COINBASE_PREVOUT = bytes(32) + b'\xff'*4
+SEQUENCE_FINAL = b'\xff'*4
+ZERO_SATS = bytes(8)
+# A single 32 byte witness reserved value of all zeros
+COINBASE_WITNESS = b'\x01\x20' + bytes(32)
+LOCKTIME_ZERO = bytes(4)
+
+# Watchdog for a held getblocktemplate longpoll. The node answers on a new block,
+# or once the mempool has changed and a minute has passed (rechecked every 10s),
+# so this has to stay well above that window; a client side timeout leaves the
+# request holding one of the node's rpc threads.
+LONGPOLL_TIMEOUT = 120
+# A submitblock request only differs by the block hex, which needs no escaping
+SUBMITBLOCK_PREFIX = b'{"jsonrpc":"2.0","id":"0","method":"submitblock","params":["'
+SUBMITBLOCK_SUFFIX = b'"]}'
 hashratedict = {}
 
 def var_int(i: int) -> bytes:
@@ -44,19 +75,122 @@ def op_push(i: int) -> bytes:
         return b'\x4e'+i.to_bytes(4, 'little')
 
 
+def p2pkh_script(h160: bytes) -> bytes:
+    # Returned with its length prefix, ready to go into a vout
+    script = b'\x76\xa9\x14' + h160 + b'\x88\xac'
+    return op_push(len(script)) + script
+
+
+# Already pushed, as it goes into the coinbase script
+ARBITRARY_DATA_PUSH = op_push(len(ARBITRARY_DATA)) + ARBITRARY_DATA
+
+
 def dsha256(b):
+    # hashlib is backed by OpenSSL, which already uses SHA-NI when the cpu has it.
+    # What is left to trim is the python overhead around each call.
     return sha256(sha256(b).digest()).digest()
 
-def merkle_from_txids(txids: List[bytes]):
+def unchanged_prefix_pairs(level: bytes, old_view: memoryview, start: int, stop: int) -> int:
+    # The end of the run of 64 byte pairs from start that are the same in both levels.
+    # startswith against a memoryview compares in place, without copying either side.
+    lo, hi = start, stop
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if level.startswith(old_view[64*start:64*mid], 64*start):
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def unchanged_suffix_pairs(level: bytes, old_view: memoryview, start: int, stop: int) -> int:
+    # The start of the run of 64 byte pairs up to the end that are the same in both levels,
+    # which must be the same length
+    lo, hi = start, stop
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if level.endswith(old_view[64*mid:]):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def merkle_from_txids(txids: bytes, old_levels: Sequence[bytes] = ()) -> Tuple[bytes, List[bytes]]:
     # https://github.com/maaku/python-bitcoin/blob/master/bitcoin/merkle.py
+    # txids are the 32 byte leaves back to back in one buffer.
+    # old_levels are the levels returned by the last call; pairs that are the
+    # same as they were then reuse their old parents instead of being rehashed.
+    # Returns the merkle root and the levels of this tree.
     if not txids:
-        return dsha256(b'')
-    if len(txids) == 1:
-        return txids[0]
-    while len(txids) > 1:
-        txids.append(txids[-1])
-        txids = list(dsha256(l+r) for l,r in zip(*(iter(txids),)*2))
-    return txids[0]
+        return dsha256(b''), []
+    if len(txids) == 32:
+        return bytes(txids), [bytes(txids)]
+    # Work on a whole level at a time as one contiguous buffer of 32 byte hashes;
+    # every 64 byte slice is then a (left, right) pair with no per-pair concat
+    h = sha256
+    levels = []
+    level = bytes(txids)
+    depth = 0
+    while len(level) > 32:
+        if len(level) % 64:
+            level += level[-32:]
+        levels.append(level)
+        pairs = len(level) // 64
+        if depth + 1 < len(old_levels):
+            old_level = old_levels[depth]
+            old_parents = old_levels[depth + 1]
+            old_view = memoryview(old_level)
+            # The coinbase is the first leaf, so the first pair is checked on its own.
+            # After it, only the pairs from the first to the last one that changed are
+            # rehashed. Once txs shift (e.g. after a new block) that is all of them,
+            # at the cost of a few compares.
+            first = unchanged_prefix_pairs(level, old_view, 1, min(pairs, len(old_level) // 64))
+            if len(level) == len(old_level):
+                last = unchanged_suffix_pairs(level, old_view, first, pairs)
+            else:
+                last = pairs
+            parents = [old_parents[:32] if level.startswith(old_view[:64]) else h(h(level[:64]).digest()).digest(),
+                       old_parents[32:32*first]]
+            parents.extend([h(h(level[i:i+64]).digest()).digest() for i in range(64*first, 64*last, 64)])
+            parents.append(old_parents[32*last:] if last < pairs else b'')
+            level = b''.join(parents)
+        else:
+            # Nothing to reuse (the first tree, or this one is deeper), so no compares
+            level = b''.join([h(h(level[i:i+64]).digest()).digest() for i in range(0, len(level), 64)])
+        depth += 1
+    levels.append(level)
+    return bytes(level), levels
+
+B58_ALPHABET = b'123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+# Reverse lookup from a character to its base58 digit, -1 if it is not one
+B58_MAP = [B58_ALPHABET.find(c) for c in range(256)]
+
+def b58decode_check(s: str) -> bytes:
+    # https://github.com/bitcoin/bitcoin/blob/master/src/base58.cpp
+    v = 0
+    for c in s.encode('ascii'):
+        d = B58_MAP[c]
+        if d < 0:
+            raise ValueError(f'Invalid base58 character {chr(c)!r}')
+        v = v * 58 + d
+    # Leading '1's are leading zero bytes
+    b = bytes(len(s) - len(s.lstrip('1'))) + v.to_bytes((v.bit_length() + 7) // 8, 'big')
+    if len(b) < 4 or dsha256(b[:-4])[:4] != b[-4:]:
+        raise ValueError('Invalid checksum')
+    return b[:-4]
+
+# Seed hashes we have already computed, indexed by epoch
+seed_hashes = [bytes(32)]
+
+def seed_hash_from_epoch(epoch: int) -> bytes:
+    if epoch >= len(seed_hashes):
+        # Hashing is expensive, so continue the chain from the highest epoch
+        # we already know instead of from zero, keeping the loop itself tight
+        keccak_256 = sha3.keccak_256
+        seed_hash = seed_hashes[-1]
+        for _ in range(epoch + 1 - len(seed_hashes)):
+            seed_hash = keccak_256(seed_hash).digest()
+            seed_hashes.append(seed_hash)
+    return seed_hashes[epoch]
 
 class TemplateState:
     # These refer to the block that we are working on
@@ -67,6 +201,11 @@ class TemplateState:
     # The address of the miner that first connects is
     # the one that is used
     pub_h160: Optional[bytes] = None
+    # The scripts only change with the addresses, so
+    # decode and build them once instead of every coinbase
+    miner_script: Optional[bytes] = None
+    devfund_address: Optional[str] = None
+    devfund_script: Optional[bytes] = None
 
     # We store the following in hex because they are
     # Used directly in API to the miner
@@ -81,8 +220,14 @@ class TemplateState:
     header: Optional[bytes] = None
     coinbase_tx: Optional[bytes] = None
     coinbase_txid: Optional[bytes] = None
+    # Every level of the last merkle tree, so that the next one
+    # only needs to rehash what changed. These are bytes, which deepcopy
+    # shares rather than copies into each of the historical states.
+    merkle_levels: List[bytes] = []
 
     current_commitment: Optional[str] = None
+    # From the last template, used to longpoll for the next one
+    longpollid: Optional[str] = None
 
     new_sessions: Set[RPCSession] = set()
     all_sessions: Set[RPCSession] = set()
@@ -114,7 +259,7 @@ def lookup_old_state(queue, id: str) -> Optional[TemplateState]:
 
 class StratumSession(RPCSession):
 
-    def __init__(self, state: TemplateState, old_states, testnet: bool, verbose: bool, node_url: str, node_username: str, node_password: str, node_port: int, transport):
+    def __init__(self, state: TemplateState, old_states, testnet: bool, verbose: bool, http_session: ClientSession, node_rpc_url: str, transport):
         connection = JSONRPCConnection(JSONRPCAutoDetect)
         super().__init__(transport, connection=connection)
         self._state = state
@@ -123,10 +268,12 @@ class StratumSession(RPCSession):
 
         self._old_states = old_states
 
-        self._node_url = node_url
-        self._node_username = node_username
-        self._node_password = node_password
-        self._node_port = node_port
+        # Identifies this miner in the hashrate report
+        self._worker = hex(id(self))
+
+        # Shared with the state updater so that we reuse its connections to the node
+        self._http_session = http_session
+        self._node_rpc_url = node_rpc_url
 
         self.handlers = {
             'mining.subscribe': self.handle_subscribe,
@@ -146,7 +293,7 @@ class StratumSession(RPCSession):
         return await handler_invocation(handler, request)()
 
     async def connection_lost(self):
-        worker = str(self).strip('>').split()[3]
+        worker = self._worker
         if self._verbose:
             print(f'Connection lost: {worker}')
         hashratedict.pop(worker, None)
@@ -164,11 +311,12 @@ class StratumSession(RPCSession):
     async def handle_authorize(self, username: str, password: str):
         # The first address that connects is the one that is used
         address = username.split('.')[0]
-        addr_decoded = base58.b58decode_check(address)
+        addr_decoded = b58decode_check(address)
         if addr_decoded[0] != (76 if self._testnet else 76):
             raise RPCError(20, f'Invalid address {address}')
         if not self._state.pub_h160:
             self._state.pub_h160 = addr_decoded[1:]
+            self._state.miner_script = p2pkh_script(self._state.pub_h160)
         return True
 
     async def handle_submit(self, worker: str, job_id: str, nonce_hex: str, header_hex: str, mixhash_hex: str):
@@ -200,40 +348,34 @@ class StratumSession(RPCSession):
         
         block_hex = state.build_block(nonce_hex, mixhash_hex)
 
-        data = {
-            'jsonrpc':'2.0',
-            'id':'0',
-            'method':'submitblock',
-            'params':[block_hex]
-        }
-        async with ClientSession() as session:
-            async with session.post(f'http://{self._node_username}:{self._node_password}@{self._node_url}:{self._node_port}', data=json.dumps(data)) as resp:
-                json_resp = await resp.json()
-                
-                with open(f'./submit_history/{state.height}_{state.job_counter}.txt', 'w') as f:
-                    data = f'Response:\n{json.dumps(json_resp, indent=2)}\n\nState:\n{state.__repr__()}'
-                    f.write(data)
-
-                if self._verbose:
-                    print(json_resp)
-                
-                if json_resp.get('error', None):
-                    raise RPCError(20, json_resp['error'])
-                
-                result = json_resp.get('result', None)
-                if self._verbose:
-                    if result == 'inconclusive':
-                        # inconclusive - valid submission but other block may be better, etc.
-                        print('Valid block but inconclusive')
-                    elif result == 'duplicate':
-                        print('Valid block but duplicate')
-                    elif result == 'duplicate-inconclusive':
-                        print('Valid block but duplicate-inconclusive')
-                    elif result == 'inconclusive-not-best-prevblk':
-                        print('Valid block but inconclusive-not-best-prevblk')
-                
-                if result not in (None, 'inconclusive', 'duplicate', 'duplicate-inconclusive', 'inconclusive-not-best-prevblk'):
-                    raise RPCError(20, json_resp['result'])
+        data = b''.join((SUBMITBLOCK_PREFIX, block_hex.encode('ascii'), SUBMITBLOCK_SUFFIX))
+        async with self._http_session.post(self._node_rpc_url, data=data) as resp:
+            json_resp = json_loads(await resp.read())
+            
+            with open(f'./submit_history/{state.height}_{state.job_counter}.txt', 'w') as f:
+                data = f'Response:\n{json.dumps(json_resp, indent=2)}\n\nState:\n{state.__repr__()}'
+                f.write(data)
+
+            if self._verbose:
+                print(json_resp)
+            
+            if json_resp.get('error', None):
+                raise RPCError(20, json_resp['error'])
+            
+            result = json_resp.get('result', None)
+            if self._verbose:
+                if result == 'inconclusive':
+                    # inconclusive - valid submission but other block may be better, etc.
+                    print('Valid block but inconclusive')
+                elif result == 'duplicate':
+                    print('Valid block but duplicate')
+                elif result == 'duplicate-inconclusive':
+                    print('Valid block but duplicate-inconclusive')
+                elif result == 'inconclusive-not-best-prevblk':
+                    print('Valid block but inconclusive-not-best-prevblk')
+            
+            if result not in (None, 'inconclusive', 'duplicate', 'duplicate-inconclusive', 'inconclusive-not-best-prevblk'):
+                raise RPCError(20, json_resp['result'])
 
         # Get height from block hex
         block_height = int.from_bytes(bytes.fromhex(block_hex[(4+32+32+4+4)*2:(4+32+32+4+4+4)*2]), 'little', signed=False)
@@ -251,25 +393,24 @@ class StratumSession(RPCSession):
             'method':'getmininginfo',
             'params':[]
         }    
-        async with ClientSession() as session:    
-            async with session.post(f'http://{self._node_username}:{self._node_password}@{self._node_url}:{self._node_port}', data=json.dumps(data)) as resp:
-                try:
-                    json_obj = await resp.json()
-                    if json_obj.get('error', None):
-                        raise Exception(json_obj.get('error', None))
-
-                    blocks_int: int = json_obj['result']['blocks']
-                    difficulty_int: int = json_obj['result']['difficulty']
-                    networkhashps_int: int = json_obj['result']['networkhashps']
-                
-                except Exception as e:
-                    print('Failed to query mininginfo from node')
-                    import traceback
-                    traceback.print_exc()
-                    return
-        
+        async with self._http_session.post(self._node_rpc_url, data=json_dumps(data)) as resp:
+            try:
+                json_obj = json_loads(await resp.read())
+                if json_obj.get('error', None):
+                    raise Exception(json_obj.get('error', None))
+
+                blocks_int: int = json_obj['result']['blocks']
+                difficulty_int: int = json_obj['result']['difficulty']
+                networkhashps_int: int = json_obj['result']['networkhashps']
+            
+            except Exception as e:
+                print('Failed to query mininginfo from node')
+                import traceback
+                traceback.print_exc()
+                return
+
         hashrate = int(hashrate, 16)
-        worker = str(self).strip('>').split()[3]
+        worker = self._worker
         hashratedict.update({worker: hashrate})
         totalHashrate = 0
         
@@ -298,185 +439,224 @@ class StratumSession(RPCSession):
             print('Mining software has yet to send data')
         return True
 
-async def stateUpdater(state: TemplateState, old_states, drop_after, verbose, node_url: str, node_username: str, node_password: str, node_port: int):
+async def notify_new_sessions(state: TemplateState):
+    # Miners that connected since the last job went out get the current one
+    if state.headerHash is None:
+        return
+    # Taken before the first await, so that every session gets the same consistent
+    # job even if the state updater puts in a new one while we are sending
+    job_counter = state.job_counter
+    target = state.target
+    job = (hex(job_counter)[2:], state.headerHash, state.seedHash.hex(), target, True, state.height, state.bits)
+    # Stop as soon as a new job is on its way; the rest get that one next round
+    while state.new_sessions and not state.awaiting_update and state.job_counter == job_counter:
+        session = state.new_sessions.pop()
+        await session.send_notification('mining.set_target', (target,))
+        await session.send_notification('mining.notify', job)
+        if session.is_closing():
+            continue
+        if state.job_counter == job_counter:
+            state.all_sessions.add(session)
+        else:
+            # A new job went out to all_sessions while we were sending this one
+            state.new_sessions.add(session)
+
+async def notify_all_sessions(state: TemplateState):
+    # Taken before the first await, like in notify_new_sessions
+    target = state.target
+    job = (hex(state.job_counter)[2:], state.headerHash, state.seedHash.hex(), target, True, state.height, state.bits)
+    # New sessions can be added to all_sessions while we are sending
+    for session in list(state.all_sessions):
+        await session.send_notification('mining.set_target', (target,))
+        await session.send_notification('mining.notify', job)
+
+async def refresh_timestamp(state: TemplateState, old_states, drop_after, verbose):
+    # A held longpoll only returns for new blocks & new txs, so the job
+    # timestamp is refreshed here after 60s (magic number) instead.
+    # Only the time in the header changes, so nothing needs to be fetched.
+    if state.header is None or state.awaiting_update:
+        return
+    ts = int(time.time())
+    if state.timestamp + 60 >= ts:
+        return
+    if verbose:
+        print('No new template for 60s, refresh the timestamp')
+    original_state = deepcopy(state)
+    header = state.header[:68] + ts.to_bytes(4, 'little') + state.header[72:]
+    state.header = header
+    state.headerHash = dsha256(header)[::-1].hex()
+    state.timestamp = ts
+    state.job_counter += 1
+    add_old_state_to_queue(old_states, original_state, drop_after)
+    await notify_all_sessions(state)
+
+async def stateUpdater(state: TemplateState, old_states, drop_after, verbose, http_session: ClientSession, node_rpc_url: str):
     if not state.pub_h160:
         return
     data = {
         'jsonrpc':'2.0',
         'id':'0',
         'method':'getblocktemplate',
-        'params':[]
+        # The node holds a longpoll until the template actually changes
+        'params':[{'longpollid': state.longpollid}] if state.longpollid else []
     }
-    async with ClientSession() as session:
-        async with session.post(f'http://{node_username}:{node_password}@{node_url}:{node_port}', data=json.dumps(data)) as resp:
-            try:
-                json_obj = await resp.json()
-                if json_obj.get('error', None):
-                    raise Exception(json_obj.get('error', None))
-
-                version_int: int = json_obj['result']['version']
-                height_int: int = json_obj['result']['height'] 
-                bits_hex: str = json_obj['result']['bits'] 
-                prev_hash_hex: str = json_obj['result']['previousblockhash']
-                txs_list: List = json_obj['result']['transactions']
-                coinbase_sats_int: int = json_obj['result']['coinbasevalue'] 
-                coinbase_com_aut_address: str = json_obj['result']['CommunityAutonomousAddress'] #Ab8KBCTTJgy7XnsPsHbnwRMJD4MFjG12hU
-                coinbase_sats_com_aut_val_int: int = json_obj['result']['CommunityAutonomousValue']
-                witness_hex: str = json_obj['result']['default_witness_commitment']
-                coinbase_flags_hex: str = json_obj['result']['coinbaseaux']['flags']
-                target_hex: str = json_obj['result']['target']
-
-                ts = int(time.time())
-                new_witness = witness_hex != state.current_commitment
-                state.current_commitment = witness_hex
-                state.target = target_hex
-                state.bits = bits_hex
-                state.version = version_int
-                state.prevHash = bytes.fromhex(prev_hash_hex)[::-1]
-
-                new_block = False
-
-                original_state = None
-
-                # The following will only change when there is a new block.
-                # Force update is unnecessary
-                if state.height == -1 or state.height != height_int:
-                    original_state = deepcopy(state)
-                    # New block, update everything
-                    if verbose:
-                        print('New block, update state')
-                    new_block = True
-
-                    # Generate seed hash #
-                    if state.height == - 1 or height_int > state.height:
-                        if not state.seedHash:
-                            seed_hash = bytes(32)
-                            for _ in range(height_int//KAWPOW_EPOCH_LENGTH):
-                                k = sha3.keccak_256()
-                                k.update(seed_hash)
-                                seed_hash = k.digest()
-                            if verbose:
-                                print(f'Initialized seedhash to {seed_hash.hex()}')
-                            state.seedHash = seed_hash
-                        elif state.height % KAWPOW_EPOCH_LENGTH == 0:
-                            # Hashing is expensive, so want use the old val
-                            k = sha3.keccak_256()
-                            k.update(state.seedHash)
-                            seed_hash = k.digest()
-                            if verbose:
-                                print(f'updated seed hash to {seed_hash.hex()}')
-                            state.seedHash = seed_hash
-                    elif state.height > height_int:
-                        # Maybe a chain reorg?
-                        
-                        # If the difference between heights is greater than how far we are into the epoch
-                        if state.height % KAWPOW_EPOCH_LENGTH - (state.height - height_int) < 0:
-                            # We must go back an epoch; recalc
-                            seed_hash = bytes(32)
-                            for _ in range(height_int//KAWPOW_EPOCH_LENGTH):
-                                k = sha3.keccak_256()
-                                k.update(seed_hash)
-                                seed_hash = k.digest()
-                            if verbose:
-                                print(f'Reverted seedhash to {seed_hash}')
-                            state.seedHash = seed_hash
-
-                    # Done with seed hash #
-                    state.height = height_int
-
-                # The following occurs during both new blocks & new txs & nothing happens for 60s (magic number)
-                if new_block or new_witness or state.timestamp + 60 < ts:
-                    # Generate coinbase #
-
-                    if original_state is None:
-                        original_state = deepcopy(state)
-
-                    bytes_needed_sub_1 = 0
-                    while True:
-                        if state.height <= (2**(7 + (8 * bytes_needed_sub_1))) - 1:
-                            break
-                        bytes_needed_sub_1 += 1
-
-                    bip34_height = state.height.to_bytes(bytes_needed_sub_1 + 1, 'little')
-
-                    # Note that there is a max allowed length of arbitrary data.
-                    # I forget what it is (TODO lol) but note that this string is close
-                    # to the max.
-                    arbitrary_data = b'with a little help from http://github.com/kralverde/ravencoin-stratum-proxy'
-                    coinbase_script = op_push(len(bip34_height)) + bip34_height + op_push(len(arbitrary_data)) + arbitrary_data
-                    coinbase_txin = bytes(32) + b'\xff'*4 + var_int(len(coinbase_script)) + coinbase_script + b'\xff'*4
-                    vout_to_miner = b'\x76\xa9\x14' + state.pub_h160 + b'\x88\xac'
-                    vout_to_devfund = b'\x76\xa9\x14' + base58.b58decode_check(coinbase_com_aut_address)[1:] + b'\x88\xac'
-
-                    # Concerning the default_witness_commitment:
-                    # https://github.com/bitcoin/bips/blob/master/bip-0141.mediawiki#commitment-structure
-                    # Because the coinbase tx is '00'*32 in witness commit,
-                    # We can take what the node gives us directly without changing it
-                    # (This assumes that the txs are in the correct order, but I think
-                    # that is a safe assumption)
-
-                    witness_vout = bytes.fromhex(witness_hex)
-
-                    state.coinbase_tx = (int(1).to_bytes(4, 'little') + \
-                                    b'\x00\x01' + \
-                                    b'\x01' + coinbase_txin + \
-                                    b'\x03' + \
-                                        coinbase_sats_int.to_bytes(8, 'little') + op_push(len(vout_to_miner)) + vout_to_miner + \
-                                        coinbase_sats_com_aut_val_int.to_bytes(8, 'little') + op_push(len(vout_to_devfund)) + vout_to_devfund + \
-                                        bytes(8) + op_push(len(witness_vout)) + witness_vout + \
-                                    b'\x01\x20' + bytes(32) + bytes(4))
-
-                    coinbase_no_wit = int(1).to_bytes(4, 'little') + \
-                                        b'\x01' + coinbase_txin + \
-                                        b'\x03' + \
-                                            coinbase_sats_int.to_bytes(8, 'little') + op_push(len(vout_to_miner)) + vout_to_miner + \
-                                            coinbase_sats_com_aut_val_int.to_bytes(8, 'little') + op_push(len(vout_to_devfund)) + vout_to_devfund + \
-                                            bytes(8) + op_push(len(witness_vout)) + witness_vout + \
-                                        bytes(4)
-                    state.coinbase_txid = dsha256(coinbase_no_wit)
-
-
-                    # Create merkle & update txs
-                    txids = [state.coinbase_txid]
-                    incoming_txs = []
-                    for tx_data in txs_list:
-                        incoming_txs.append(tx_data['data'])
-                        txids.append(bytes.fromhex(tx_data['txid'])[::-1])
-                    state.externalTxs = incoming_txs
-                    merkle = merkle_from_txids(txids)
-
-                    # Done create merkle & update txs
-
-                    state.header = version_int.to_bytes(4, 'little') + \
-                            state.prevHash + \
-                            merkle + \
-                            ts.to_bytes(4, 'little') + \
-                            bytes.fromhex(bits_hex)[::-1] + \
-                            state.height.to_bytes(4, 'little')
-
-                    state.headerHash = dsha256(state.header)[::-1].hex()
-                    state.timestamp = ts
-
-                    state.job_counter += 1
-                    add_old_state_to_queue(old_states, original_state, drop_after)
-
-                    for session in state.all_sessions:
-                        await session.send_notification('mining.set_target', (target_hex,))
-                        await session.send_notification('mining.notify', (hex(state.job_counter)[2:], state.headerHash, state.seedHash.hex(), target_hex, True, state.height, bits_hex))
-                
-                for session in state.new_sessions:
-                    state.all_sessions.add(session)
-                    await session.send_notification('mining.set_target', (target_hex,))
-                    await session.send_notification('mining.notify', (hex(state.job_counter)[2:], state.headerHash, state.seedHash.hex(), target_hex, True, state.height, bits_hex))
-                
-                state.new_sessions.clear()
-
-            except Exception as e:
-                print('Failed to query blocktemplate from node')
-                import traceback
-                traceback.print_exc()
-                print('Sleeping for 5 minutes.\nAny solutions found during this time may not be current.\nTry restarting the proxy.')
-                await asyncio.sleep(300)
+    try:
+        # The watchdog covers the whole response: a longpoll can end right before
+        # the deadline and still be streaming the template when it hits
+        async with http_session.post(node_rpc_url, data=json_dumps(data), timeout=ClientTimeout(total=LONGPOLL_TIMEOUT)) as resp:
+            body = await resp.read()
+    except asyncio.TimeoutError:
+        # The node should have answered long before this; start over with
+        # a plain request in case the longpoll got lost
+        state.longpollid = None
+        return
+    try:
+        json_obj = json_loads(body)
+        if json_obj.get('error', None):
+            raise Exception(json_obj.get('error', None))
+
+        version_int: int = json_obj['result']['version']
+        height_int: int = json_obj['result']['height'] 
+        bits_hex: str = json_obj['result']['bits'] 
+        prev_hash_hex: str = json_obj['result']['previousblockhash']
+        txs_list: List = json_obj['result']['transactions']
+        coinbase_sats_int: int = json_obj['result']['coinbasevalue'] 
+        coinbase_com_aut_address: str = json_obj['result']['CommunityAutonomousAddress'] #Ab8KBCTTJgy7XnsPsHbnwRMJD4MFjG12hU
+        coinbase_sats_com_aut_val_int: int = json_obj['result']['CommunityAutonomousValue']
+        witness_hex: str = json_obj['result']['default_witness_commitment']
+        coinbase_flags_hex: str = json_obj['result']['coinbaseaux']['flags']
+        target_hex: str = json_obj['result']['target']
+        longpollid: Optional[str] = json_obj['result'].get('longpollid', None)
+
+        ts = int(time.time())
+        new_witness = witness_hex != state.current_commitment
+        prev_hash = bytes.fromhex(prev_hash_hex)[::-1]
+
+        # The following will only change when there is a new block.
+        # Force update is unnecessary
+        new_block = state.height == -1 or state.height != height_int
+
+        # A new job is made for new blocks & new txs & nothing happens for 60s (magic number),
+        # otherwise the current one stays and only the plain template fields are refreshed
+        if not (new_block or new_witness or state.timestamp + 60 < ts):
+            state.target = target_hex
+            state.bits = bits_hex
+            state.version = version_int
+            state.prevHash = prev_hash
+            state.longpollid = longpollid
+        else:
+            # There is an await below where miners can be sent jobs and submit
+            # solutions. The new template is built in locals and only put into
+            # the state all at once after it, so they never see half of it.
+            original_state = deepcopy(state)
+
+            if new_block:
+                # New block, update everything
+                if verbose:
+                    print('New block, update state')
+
+                # Generate seed hash #
+                # Also covers reorgs back into an older epoch
+                seed_hash = seed_hash_from_epoch(height_int // KAWPOW_EPOCH_LENGTH)
+                if verbose and seed_hash != state.seedHash:
+                    print(f'Updated seed hash to {seed_hash.hex()}')
+                # Done with seed hash #
+            else:
+                seed_hash = state.seedHash
+
+            # Generate coinbase #
+
+            # Minimal signed little endian, so the top bit of the last byte stays clear
+            bip34_height = height_int.to_bytes(height_int.bit_length() // 8 + 1, 'little')
+
+            coinbase_txin = b''.join((COINBASE_PREVOUT,
+                                var_int(1 + len(bip34_height) + len(ARBITRARY_DATA_PUSH)),
+                                op_push(len(bip34_height)), bip34_height, ARBITRARY_DATA_PUSH,
+                                SEQUENCE_FINAL))
+            if coinbase_com_aut_address != state.devfund_address:
+                state.devfund_script = p2pkh_script(b58decode_check(coinbase_com_aut_address)[1:])
+                state.devfund_address = coinbase_com_aut_address
+
+            # Concerning the default_witness_commitment:
+            # https://github.com/bitcoin/bips/blob/master/bip-0141.mediawiki#commitment-structure
+            # Because the coinbase tx is '00'*32 in witness commit,
+            # We can take what the node gives us directly without changing it
+            # (This assumes that the txs are in the correct order, but I think
+            # that is a safe assumption)
+
+            witness_vout = bytes.fromhex(witness_hex)
+
+            # The vin and vouts are the same with and without the witness
+            coinbase_vin_vouts = b''.join((b'\x01', coinbase_txin,
+                                    b'\x03',
+                                        coinbase_sats_int.to_bytes(8, 'little'), state.miner_script,
+                                        coinbase_sats_com_aut_val_int.to_bytes(8, 'little'), state.devfund_script,
+                                        ZERO_SATS, op_push(len(witness_vout)), witness_vout))
+
+            coinbase_tx = b''.join((COINBASE_VERSION, SEGWIT_MARKER_FLAG, coinbase_vin_vouts, COINBASE_WITNESS, LOCKTIME_ZERO))
+
+            coinbase_no_wit = b''.join((COINBASE_VERSION, coinbase_vin_vouts, LOCKTIME_ZERO))
+            coinbase_txid = dsha256(coinbase_no_wit)
+
+
+            # Create merkle & update txs
+            # The leaves go into one contiguous buffer, coinbase first.
+            # All txids are decoded with a single fromhex: joining them in
+            # reverse order and then reversing the bytes flips each txid
+            # while putting them back in their original order.
+            txids = bytearray(coinbase_txid)
+            txids += bytes.fromhex(''.join([tx_data['txid'] for tx_data in reversed(txs_list)]))[::-1]
+            incoming_txs = [tx_data['data'] for tx_data in txs_list]
+            # Big blocks can take a while to hash; do it off the event loop so
+            # that miners are still answered in the meantime.
+            # New sessions wait for the new job instead of getting the old one.
+            state.awaiting_update = True
+            # After a new block the mined txs are gone from the front, so nothing
+            # lines up with the old tree anymore and it is not worth comparing against
+            old_levels = () if new_block else state.merkle_levels
+            merkle, merkle_levels = await asyncio.get_running_loop().run_in_executor(None, merkle_from_txids, txids, old_levels)
+
+            # Done create merkle & update txs
+
+            header = version_int.to_bytes(4, 'little') + \
+                    prev_hash + \
+                    merkle + \
+                    ts.to_bytes(4, 'little') + \
+                    bytes.fromhex(bits_hex)[::-1] + \
+                    height_int.to_bytes(4, 'little')
+
+            # Everything for the new job goes in together, with no await in between
+            state.current_commitment = witness_hex
+            state.target = target_hex
+            state.bits = bits_hex
+            state.version = version_int
+            state.prevHash = prev_hash
+            state.height = height_int
+            state.seedHash = seed_hash
+            state.merkle_levels = merkle_levels
+            state.coinbase_tx = coinbase_tx
+            state.coinbase_txid = coinbase_txid
+            state.externalTxs = incoming_txs
+            state.header = header
+            state.headerHash = dsha256(header)[::-1].hex()
+            state.timestamp = ts
+            state.longpollid = longpollid
+            state.job_counter += 1
+            state.awaiting_update = False
+
+            add_old_state_to_queue(old_states, original_state, drop_after)
+
+            await notify_all_sessions(state)
+
+        await notify_new_sessions(state)
+
+    except Exception as e:
+        state.awaiting_update = False
+        print('Failed to query blocktemplate from node')
+        import traceback
+        traceback.print_exc()
+        print('Sleeping for 5 minutes.\nAny solutions found during this time may not be current.\nTry restarting the proxy.')
+        await asyncio.sleep(300)
 
 if __name__ == '__main__':
 
@@ -515,23 +695,38 @@ if __name__ == '__main__':
     # only save 20 historic states (magic number)
     store = 20
 
-    session_generator = partial(StratumSession, state, historical_states, testnet, verbose, node_url, node_username, node_password, node_port)
+    node_rpc_url = f'http://{node_username}:{node_password}@{node_url}:{node_port}'
+
+    async def updateState(http_session: ClientSession):
+        while True:
+            await stateUpdater(state, historical_states, store, verbose, http_session, node_rpc_url)
+            if state.longpollid is None:
+                # Without a longpoll, check for new blocks / new transactions every 0.1 seconds
+                # stateUpdater should fast fail if no differences
+                await asyncio.sleep(0.1)
 
-    async def updateState():
+    async def notifySessions():
         while True:
-            await stateUpdater(state, historical_states, store, verbose, node_url, node_username, node_password, node_port)
-            # Check for new blocks / new transactions every 0.1 seconds
-            # stateUpdater should fast fail if no differences
+            # A longpoll can be held for a while, so new miners get sent
+            # the current job (and the 60s timestamp refresh) from here
+            # instead of waiting on it
+            await refresh_timestamp(state, historical_states, store, verbose)
+            await notify_new_sessions(state)
             await asyncio.sleep(0.1)
 
-    async def beginServing():
+    async def beginServing(http_session: ClientSession):
+        session_generator = partial(StratumSession, state, historical_states, testnet, verbose, http_session, node_rpc_url)
         server = await serve_rs(session_generator, None if should_listen_externaly else '127.0.0.1', proxy_port, reuse_address=True)
         await server.serve_forever()
 
     async def execute():
-        async with TaskGroup(wait=any) as group:
-            await group.spawn(updateState())
-            await group.spawn(beginServing())
+        # One http session for everything that talks to the node, so that
+        # polling and submitting reuse kept-alive connections
+        async with ClientSession(connector=TCPConnector(limit=4, keepalive_timeout=60)) as http_session:
+            async with TaskGroup(wait=any) as group:
+                await group.spawn(updateState(http_session))
+                await group.spawn(notifySessions())
+                await group.spawn(beginServing(http_session))
 
         for task in group.tasks:
             if not task.cancelled():